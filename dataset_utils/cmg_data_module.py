@@ -1,14 +1,17 @@
 import os
+from typing import Optional
 
+import torch
 import pytorch_lightning as pl
 
-from transformers import RobertaTokenizer, GPT2Tokenizer
+from transformers import RobertaTokenizerFast, GPT2TokenizerFast
 
 import hydra
 from omegaconf import DictConfig
 
 from dataset_utils.cmg_dataset_w_history import CMGDatasetWithHistory
-from dataset_utils.data_collators import DataCollatorWithHistory, DataCollatorWithoutHistory
+from dataset_utils.data_collators import DataCollatorWithHistory, DataCollatorWithoutHistory, TestingDataCollator
+from dataset_utils.cuda_prefetcher import CUDAPrefetcher
 from dataset_utils.data_preprocessor import DataPreprocessor
 
 
@@ -23,7 +26,10 @@ class CMGDataModule(pl.LightningDataModule):
                  with_history: bool,
                  train_dataloader_conf: DictConfig,
                  val_dataloader_conf: DictConfig,
-                 test_dataloader_conf: DictConfig):
+                 test_dataloader_conf: DictConfig,
+                 pad_to_multiple_of: Optional[int] = 8,
+                 cuda_prefetch: bool = False,
+                 testing: bool = False):
         super().__init__()
 
         self.dataset_root = hydra.utils.to_absolute_path(dataset_root)
@@ -32,27 +38,37 @@ class CMGDataModule(pl.LightningDataModule):
         self.local_rank = local_rank
         self.world_size = world_size
 
-        self.train_dataloader_conf = train_dataloader_conf
-        self.val_dataloader_conf = val_dataloader_conf
-        self.test_dataloader_conf = test_dataloader_conf
+        # collation is done in worker processes, values from config override these defaults
+        dataloader_defaults = {'num_workers': min(8, os.cpu_count() or 1),
+                               'persistent_workers': True,
+                               'prefetch_factor': 4}
+        self.train_dataloader_conf = {**dataloader_defaults, **train_dataloader_conf}
+        self.val_dataloader_conf = {**dataloader_defaults, **val_dataloader_conf}
+        self.test_dataloader_conf = {**dataloader_defaults, **test_dataloader_conf}
 
-        self._src_tokenizer = RobertaTokenizer.from_pretrained(encoder_name_or_path)
-        self._trg_tokenizer = GPT2Tokenizer.from_pretrained(decoder_name_or_path)
+        # copy batches to GPU in advance (only makes sense when GPU is available)
+        self.cuda_prefetch = cuda_prefetch and torch.cuda.is_available()
+
+        self._src_tokenizer = RobertaTokenizerFast.from_pretrained(encoder_name_or_path)
+        self._trg_tokenizer = GPT2TokenizerFast.from_pretrained(decoder_name_or_path)
 
         # set pad_token_id to unk_token_id -> be careful here as unk_token_id == eos_token_id == bos_token_id
         # (from https://huggingface.co/patrickvonplaten/bert2gpt2-cnn_dailymail-fp16)
         self._trg_tokenizer.pad_token = self._trg_tokenizer.unk_token
 
-        if with_history:
+        if testing:
+            # random tensors instead of actual data
+            self.data_collator = TestingDataCollator(max_len=self.history_max_len)
+        elif with_history:
             self.data_collator = DataCollatorWithHistory(src_tokenizer=self._src_tokenizer,
                                                          trg_tokenizer=self._trg_tokenizer,
                                                          max_len=self.history_max_len,
-                                                         testing=False)
+                                                         pad_to_multiple_of=pad_to_multiple_of)
         else:
             self.data_collator = DataCollatorWithoutHistory(src_tokenizer=self._src_tokenizer,
                                                             trg_tokenizer=self._trg_tokenizer,
                                                             max_len=self.history_max_len,
-                                                            testing=False)
+                                                            pad_to_multiple_of=pad_to_multiple_of)
 
         # datasets are initialized later
         self.train = None
@@ -61,8 +77,8 @@ class CMGDataModule(pl.LightningDataModule):
 
     def prepare_data(self):
         # called only on 1 GPU
-        if 'train.json' not in os.listdir(self.dataset_root):
-            DataPreprocessor.create_files(self.dataset_root)
+        # (parts of dataset that were already processed during previous runs are skipped)
+        DataPreprocessor.create_files(self.dataset_root)
 
     def setup(self, stage=None):
         # called on every GPU
@@ -79,11 +95,19 @@ class CMGDataModule(pl.LightningDataModule):
                                                         rank=self.local_rank,
                                                         world_size=self.world_size)
 
+    def _wrap_dataloader(self, dataloader):
+        if self.cuda_prefetch:
+            return CUDAPrefetcher(dataloader)
+        return dataloader
+
     def train_dataloader(self):
-        return self.train.get_dataloader(**self.train_dataloader_conf, collate_fn=self.data_collator)
+        return self._wrap_dataloader(self.train.get_dataloader(**self.train_dataloader_conf,
+                                                               collate_fn=self.data_collator))
 
     def val_dataloader(self):
-        return self.val.get_dataloader(**self.val_dataloader_conf, collate_fn=self.data_collator)
+        return self._wrap_dataloader(self.val.get_dataloader(**self.val_dataloader_conf,
+                                                             collate_fn=self.data_collator))
 
     def test_dataloader(self):
-        return self.test.get_dataloader(**self.test_dataloader_conf, collate_fn=self.data_collator)
+        return self._wrap_dataloader(self.test.get_dataloader(**self.test_dataloader_conf,
+                                                              collate_fn=self.data_collator))
@@ -5,7 +5,7 @@ import random
 from typing import List, Dict, Generator, Iterator
 import torch
 from torch.utils.data import IterableDataset, DataLoader
-from transformers import RobertaTokenizer, GPT2Tokenizer
+from transformers import RobertaTokenizerFast, GPT2TokenizerFast
 
 from dataset_utils.data_collators import DataCollatorWithHistory
 
@@ -29,12 +29,27 @@ class CMGDatasetWithHistory(IterableDataset):
         self.filename = filename
         self.history = history
 
-        with open(filename, 'r') as f:
-            self._len = sum(1 for _ in f)
+        self._len = CMGDatasetWithHistory._count_lines(filename)
 
         self._gpu_rank = rank
         self._gpu_world_size = world_size
         self._num_workers = None
+        self._batch_size = None
+        self._bucket_size = 0
+
+    @staticmethod
+    def _count_lines(filename: str, chunk_size: int = 1 << 20) -> int:
+        """Counts lines in file by reading it in binary chunks (without decoding and splitting it into lines)."""
+        num_lines = 0
+        last_chunk = b''
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                num_lines += chunk.count(b'\n')
+                last_chunk = chunk
+        # last line might not end with \n (e.g. pandas doesn't write it)
+        if last_chunk and not last_chunk.endswith(b'\n'):
+            num_lines += 1
+        return num_lines
 
     @staticmethod
     def _init_worker_fn(worker_id: int) -> None:
@@ -62,17 +77,59 @@ class CMGDatasetWithHistory(IterableDataset):
                            'msg_input_ids': self.history[str(line['author'])][line['pos_in_history']],
                            'history_input_ids': self.history[str(line['author'])][:line['pos_in_history']]}
 
+    def _get_bucketed_examples_generator(self) -> Generator[Dict[str, List[int]], None, None]:
+        """
+        Groups examples of similar length into the same batches to reduce amount of padding.
+
+        This function reads bucket_size * batch_size examples into buffer, sorts them by length of diff and message
+        and yields them batch by batch (batches from one buffer go in random order).
+        """
+        buffer_size = self._bucket_size * self._batch_size
+        buffer = []
+        for example in self._get_examples_generator():
+            buffer.append(example)
+            if len(buffer) == buffer_size:
+                yield from self._get_sorted_batches(buffer)
+                buffer = []
+        yield from self._get_sorted_batches(buffer)
+
+    def _get_sorted_batches(self, buffer: List[Dict[str, List[int]]]) -> Iterator[Dict[str, List[int]]]:
+        buffer.sort(key=lambda e: len(e['diff_input_ids']) + len(e['msg_input_ids']))
+        batches = [buffer[i:i + self._batch_size] for i in range(0, len(buffer), self._batch_size)]
+        # incomplete batch can only be the last one and it should stay last to keep batches aligned
+        last_batch = batches.pop() if batches and len(batches[-1]) < self._batch_size else None
+        random.shuffle(batches)
+        if last_batch is not None:
+            batches.append(last_batch)
+        for batch in batches:
+            yield from batch
+
     def __iter__(self) -> Iterator[Dict[str, List[int]]]:
         assert self._num_workers is not None, f"You must access __iter__ through DataLoader"
+        if self._bucket_size:
+            return iter(self._get_bucketed_examples_generator())
         return iter(self._get_examples_generator())
 
-    def get_dataloader(self, batch_size: int, num_workers: int, collate_fn: DataCollatorWithHistory) -> DataLoader:
-        """Creates DataLoader in a proper way."""
+    def get_dataloader(self, batch_size: int, num_workers: int, collate_fn: DataCollatorWithHistory,
+                       bucket_size: int = 0, persistent_workers: bool = False,
+                       prefetch_factor: int = 2, drop_last: bool = False) -> DataLoader:
+        """
+        Creates DataLoader in a proper way.
+
+        :param bucket_size: if > 0, examples of similar length are grouped into batches,
+                            sorting is done in buffers of bucket_size batches
+        :param persistent_workers: whether to keep worker processes alive between epochs
+        :param prefetch_factor: number of batches loaded in advance by each worker
+        :param drop_last: whether to skip the last incomplete batch of each worker
+        """
         assert num_workers >= 0, "num_workers must be at least 0"
+        assert bucket_size >= 0, "bucket_size must be at least 0"
         if num_workers == 0:
             # We need to initialize at least 1 worker in order to call worker_init_fn
             num_workers = 1
         self._num_workers = num_workers
+        self._batch_size = batch_size
+        self._bucket_size = bucket_size
 
         return DataLoader(
             dataset=self,
@@ -81,6 +138,9 @@ class CMGDatasetWithHistory(IterableDataset):
             collate_fn=collate_fn,
             pin_memory=torch.cuda.is_available(),
             worker_init_fn=CMGDatasetWithHistory._init_worker_fn,
+            persistent_workers=persistent_workers,
+            prefetch_factor=prefetch_factor,
+            drop_last=drop_last,
         )
 
     @staticmethod
@@ -105,8 +165,8 @@ class CMGDatasetWithHistory(IterableDataset):
 
 
 if __name__ == "__main__":
-    diff_tokenizer = RobertaTokenizer.from_pretrained('microsoft/codebert-base')
-    msg_tokenizer = GPT2Tokenizer.from_pretrained("distilgpt2")
+    diff_tokenizer = RobertaTokenizerFast.from_pretrained('microsoft/codebert-base')
+    msg_tokenizer = GPT2TokenizerFast.from_pretrained("distilgpt2")
     msg_tokenizer.pad_token = msg_tokenizer.unk_token
 
     test_dataset = CMGDatasetWithHistory.load_data('../raw_data/github_data/test',
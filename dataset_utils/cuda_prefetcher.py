@@ -0,0 +1,45 @@
+from typing import Dict, Iterator, Optional
+import torch
+from torch.utils.data import DataLoader
+
+
+class CUDAPrefetcher:
+    """
+    Wrapper around DataLoader that copies next batch to GPU on a separate CUDA stream
+    while current batch is processed (based on data_prefetcher from NVIDIA APEX ImageNet example).
+
+    Batches should be pinned (DataLoader with pin_memory=True) so that copies are really asynchronous.
+    """
+
+    def __init__(self, dataloader: DataLoader, device: Optional[torch.device] = None):
+        self.dataloader = dataloader
+        # PyTorch Lightning checks dataset type to find out whether dataloader has length
+        self.dataset = dataloader.dataset
+        self.device = device
+
+    @staticmethod
+    def _to_device(batch: Optional[Dict[str, torch.Tensor]], device: torch.device,
+                   stream: torch.cuda.Stream) -> Optional[Dict[str, torch.Tensor]]:
+        if batch is None:
+            return None
+        with torch.cuda.stream(stream):
+            return {key: value.to(device, non_blocking=True) for key, value in batch.items()}
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        # current device is resolved lazily because in DDP it is set only after dataloaders are created
+        device = self.device if self.device is not None else torch.device('cuda', torch.cuda.current_device())
+        stream = torch.cuda.Stream(device=device)
+        current_stream = torch.cuda.current_stream(device)
+
+        batches = iter(self.dataloader)
+        next_batch = CUDAPrefetcher._to_device(next(batches, None), device, stream)
+        while next_batch is not None:
+            # wait until copy of the batch is finished before giving it to the model
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            for value in batch.values():
+                # memory was allocated on side stream but tensor is used on current one
+                value.record_stream(current_stream)
+            # start copying next batch while model works with current one
+            next_batch = CUDAPrefetcher._to_device(next(batches, None), device, stream)
+            yield batch
@@ -1,9 +1,37 @@
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Union, Dict
+from typing import List, Union, Dict, Optional
+import numpy as np
 import torch
 from transformers import PreTrainedTokenizerBase
 
 
+def _get_padded_len(sequences: List[List[int]], pad_to_multiple_of: Optional[int]) -> int:
+    """Returns max length of sequences in batch (rounded up to multiple of pad_to_multiple_of, if given)."""
+    max_len = max(len(seq) for seq in sequences)
+    if pad_to_multiple_of:
+        # round lengths up so that fp16 matmuls can use Tensor Cores
+        max_len = ((max_len + pad_to_multiple_of - 1) // pad_to_multiple_of) * pad_to_multiple_of
+    return max_len
+
+
+def _pad_right(sequences: List[List[int]], pad_value: int, max_len: int) -> torch.Tensor:
+    """Allocates tensor of torch.int64 for the whole batch at once and copies every sequence into its row."""
+    padded = torch.full((len(sequences), max_len), pad_value, dtype=torch.int64)
+    for i, seq in enumerate(sequences):
+        # numpy converts lists of ints faster than torch, and from_numpy doesn't copy
+        padded[i, :len(seq)] = torch.from_numpy(np.asarray(seq, dtype=np.int64))
+    return padded
+
+
+def _attention_mask_right(sequences: List[List[int]], max_len: int) -> torch.Tensor:
+    """Returns boolean mask: True on tokens and False on right-side padding (HuggingFace models cast it to float)."""
+    mask = torch.zeros((len(sequences), max_len), dtype=torch.bool)
+    for i, seq in enumerate(sequences):
+        mask[i, :len(seq)] = True
+    return mask
+
+
 @dataclass
 class DataCollatorWithHistory:
     """
@@ -18,100 +46,64 @@ class DataCollatorWithHistory:
     src_tokenizer: PreTrainedTokenizerBase
     trg_tokenizer: PreTrainedTokenizerBase
     max_len: int
-    testing: bool = False
+    pad_to_multiple_of: Optional[int] = 8
+
+    def __post_init__(self):
+        # special tokens and separator between messages from history don't change, so look them up only once
+        self._src_pad_id = self.src_tokenizer.pad_token_id
+        self._trg_pad_id = self.trg_tokenizer.pad_token_id
+        self._bos_id = self.trg_tokenizer.bos_token_id
+        self._eos_id = self.trg_tokenizer.eos_token_id
+        self._sep_ids = self.trg_tokenizer(r' \n ', add_special_tokens=False).input_ids
+        self._sep_len = len(self._sep_ids)
 
     def __call__(
             self, examples: List[Dict[str, Union[List[List[int]],
                                                  List[List[List[int]]],
                                                  torch.Tensor]]]
     ) -> Dict[str, torch.Tensor]:
-        if not self.testing:
-            diff_inputs = [e['diff_input_ids'] for e in examples]  # 2D - list of lists
-            message_inputs = [e["msg_input_ids"] for e in examples]  # 2D - list of lists
-            history_inputs = [e["history_input_ids"] for e in examples]  # 3D - list of lists (empty/lists of lists)
-
-            all_msg_ids = []     # input for training or metrics: history + cur_msg (right-side padding)
-            all_msg_masks = []   # 0 on pad tokens and 1 otherwise (right-side padding)
-            all_msg_labels = []  # -100 on history & padding to avoid computing loss (right-side padding)
-
-            # concatenate history examples with current input ids (checking that resulting length is <= max_len)
-            for message_ids, history_ids in zip(message_inputs, history_inputs):
-                cur_ids = [[self.trg_tokenizer.bos_token_id],
-                           message_ids[:self.max_len - 2],
-                           [self.trg_tokenizer.eos_token_id]]
-                cur_labels = [[-100], message_ids[:self.max_len - 2], [-100]]
-                cur_len = len(message_ids[:self.max_len - 2]) + 2
-
-                for history_input_ids in history_ids[::-1]:
-                    # insert prev messages from history until we reach max_len
-                    if cur_len + len(history_input_ids) + len(self.trg_tokenizer(r' \n ').input_ids) > self.max_len:
-                        break
-
-                    cur_len += len(history_input_ids) + len(self.trg_tokenizer(r' \n ').input_ids)
-
-                    cur_ids.insert(1, history_input_ids + self.trg_tokenizer(r' \n ').input_ids)
-                    cur_labels.insert(1, [-100 for _ in history_input_ids + self.trg_tokenizer(r' \n ').input_ids])
-
-                # flatten everything into one sequence and convert to tensor of torch.int64
-                cur_ids = torch.tensor([ex for sublist in cur_ids for ex in sublist], dtype=torch.int64)
-                cur_labels = torch.tensor([ex for sublist in cur_labels for ex in sublist], dtype=torch.int64)
-
-                # create ones for attention mask
-                cur_mask = torch.ones_like(cur_ids)
-
-                all_msg_ids.append(cur_ids)
-                all_msg_labels.append(cur_labels)
-                all_msg_masks.append(cur_mask)
-
-            all_diff_ids = [torch.tensor(ids, dtype=torch.int64) for ids in diff_inputs]
-            all_diff_masks = [torch.ones_like(ids) for ids in all_diff_ids]
-
-            msg_max_len = max(len(tensor) for tensor in all_msg_ids)
-            diff_max_len = max(len(tensor) for tensor in all_diff_ids)
-
-            # pad tensors to max length in batch
-            for i, (diff_id_tensor, diff_mask_tensor,
-                    msg_id_tensor, msg_mask_tensor, labels_tensor) in \
-                    enumerate(zip(all_diff_ids, all_diff_masks,
-                                  all_msg_ids, all_msg_masks, all_msg_labels)):
-                # pad ids with pad_token_id (which doesn't really matter for GPT-2)
-                all_msg_ids[i] = torch.nn.functional.pad(msg_id_tensor, pad=[0, msg_max_len - msg_id_tensor.numel()],
-                                                         mode='constant',
-                                                         value=self.trg_tokenizer.pad_token_id)
-                all_diff_ids[i] = torch.nn.functional.pad(diff_id_tensor, pad=[0, diff_max_len - diff_id_tensor.numel()],
-                                                          mode='constant',
-                                                          value=self.src_tokenizer.pad_token_id)
-
-                # pad labels with -100
-                all_msg_labels[i] = torch.nn.functional.pad(labels_tensor, pad=[0, msg_max_len - labels_tensor.numel()],
-                                                            mode='constant', value=-100)
-
-                # pad masks with zeros
-                all_msg_masks[i] = torch.nn.functional.pad(msg_mask_tensor, pad=[0, msg_max_len - msg_mask_tensor.numel()],
-                                                           mode='constant', value=0)
-                all_diff_masks[i] = torch.nn.functional.pad(diff_mask_tensor,
-                                                            pad=[0, diff_max_len - diff_mask_tensor.numel()],
-                                                            mode='constant', value=0)
-
-            all_diff_ids = torch.stack(all_diff_ids)
-            all_diff_masks = torch.stack(all_diff_masks)
-
-            all_msg_ids = torch.stack(all_msg_ids)
-            all_msg_masks = torch.stack(all_msg_masks)
-            all_msg_labels = torch.stack(all_msg_labels)
-
-            return {"diff_input_ids": all_diff_ids,
-                    "diff_attention_mask": all_diff_masks,
-                    "msg_input_ids": all_msg_ids,
-                    "msg_attention_mask": all_msg_masks,
-                    "msg_labels": all_msg_labels}
-        else:
-            batch_size = len(examples)
-            return {"diff_input_ids": torch.randint(10, (batch_size, 500), dtype=torch.int64),
-                    "diff_attention_mask": torch.ones(batch_size, 500, dtype=torch.int64),
-                    "msg_input_ids": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64),
-                    "msg_attention_mask": torch.ones(batch_size, self.max_len, dtype=torch.int64),
-                    "msg_labels": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64)}
+        diff_inputs = [e['diff_input_ids'] for e in examples]  # 2D - list of lists
+        message_inputs = [e["msg_input_ids"] for e in examples]  # 2D - list of lists
+        history_inputs = [e["history_input_ids"] for e in examples]  # 3D - list of lists (empty/lists of lists)
+
+        msg_ids_list = []     # input for training or metrics: history + cur_msg
+        msg_labels_list = []  # -100 on history to avoid computing loss
+
+        # concatenate history examples with current input ids (checking that resulting length is <= max_len)
+        for message_ids, history_ids in zip(message_inputs, history_inputs):
+            message_ids = message_ids[:self.max_len - 2]
+            # history is prepended to current message, so deque is used instead of list.insert(0, ...)
+            cur_history = deque()
+            cur_len = len(message_ids) + 2
+
+            for history_input_ids in reversed(history_ids):
+                # insert prev messages from history until we reach max_len
+                segment_len = len(history_input_ids) + self._sep_len
+                if cur_len + segment_len > self.max_len:
+                    break
+                cur_len += segment_len
+                cur_history.appendleft(history_input_ids + self._sep_ids)
+
+            # flatten everything into one sequence: <bos> history cur_msg <eos>
+            cur_ids = [self._bos_id]
+            for history_segment in cur_history:
+                cur_ids.extend(history_segment)
+            cur_ids += message_ids + [self._eos_id]
+            # everything except current message is -100
+            cur_labels = [-100] * (cur_len - len(message_ids) - 1) + message_ids + [-100]
+
+            msg_ids_list.append(cur_ids)
+            msg_labels_list.append(cur_labels)
+
+        msg_max_len = _get_padded_len(msg_ids_list, self.pad_to_multiple_of)
+        diff_max_len = _get_padded_len(diff_inputs, self.pad_to_multiple_of)
+
+        # ids are padded with pad_token_id (which doesn't really matter for GPT-2), labels with -100
+        return {"diff_input_ids": _pad_right(diff_inputs, self._src_pad_id, diff_max_len),
+                "diff_attention_mask": _attention_mask_right(diff_inputs, diff_max_len),
+                "msg_input_ids": _pad_right(msg_ids_list, self._trg_pad_id, msg_max_len),
+                "msg_attention_mask": _attention_mask_right(msg_ids_list, msg_max_len),
+                "msg_labels": _pad_right(msg_labels_list, -100, msg_max_len)}
 
 
 @dataclass
@@ -127,84 +119,59 @@ class DataCollatorWithoutHistory:
     src_tokenizer: PreTrainedTokenizerBase
     trg_tokenizer: PreTrainedTokenizerBase
     max_len: int
-    testing: bool = False
+    pad_to_multiple_of: Optional[int] = 8
+
+    def __post_init__(self):
+        # special tokens don't change, so look them up only once
+        self._src_pad_id = self.src_tokenizer.pad_token_id
+        self._trg_pad_id = self.trg_tokenizer.pad_token_id
+        self._bos_id = self.trg_tokenizer.bos_token_id
+        self._eos_id = self.trg_tokenizer.eos_token_id
+
+    def __call__(
+            self, examples: List[Dict[str, Union[List[List[int]],
+                                                 List[List[List[int]]],
+                                                 torch.Tensor]]]
+    ) -> Dict[str, torch.Tensor]:
+        diff_inputs = [e['diff_input_ids'] for e in examples]  # 2D - list of lists
+        message_inputs = [e["msg_input_ids"] for e in examples]  # 2D - list of lists
+
+        msg_ids_list = []     # input for training or metrics: cur_msg
+        msg_labels_list = []  # -100 on special tokens to avoid computing loss
+
+        for message_ids in message_inputs:
+            message_ids = message_ids[:self.max_len - 2]
+            msg_ids_list.append([self._bos_id] + message_ids + [self._eos_id])
+            msg_labels_list.append([-100] + message_ids + [-100])
+
+        msg_max_len = _get_padded_len(msg_ids_list, self.pad_to_multiple_of)
+        diff_max_len = _get_padded_len(diff_inputs, self.pad_to_multiple_of)
+
+        # ids are padded with pad_token_id (which doesn't really matter for GPT-2), labels with -100
+        return {"diff_input_ids": _pad_right(diff_inputs, self._src_pad_id, diff_max_len),
+                "diff_attention_mask": _attention_mask_right(diff_inputs, diff_max_len),
+                "msg_input_ids": _pad_right(msg_ids_list, self._trg_pad_id, msg_max_len),
+                "msg_attention_mask": _attention_mask_right(msg_ids_list, msg_max_len),
+                "msg_labels": _pad_right(msg_labels_list, -100, msg_max_len)}
+
+
+@dataclass
+class TestingDataCollator:
+    """
+    Data collator used for testing purposes: returns random tensors of fixed shapes
+    (diffs are always 500 tokens long, messages are always max_len tokens long)
+    """
+
+    max_len: int
 
     def __call__(
             self, examples: List[Dict[str, Union[List[List[int]],
                                                  List[List[List[int]]],
                                                  torch.Tensor]]]
     ) -> Dict[str, torch.Tensor]:
-        if not self.testing:
-            diff_inputs = [e['diff_input_ids'] for e in examples]  # 2D - list of lists
-            message_inputs = [e["msg_input_ids"] for e in examples]  # 2D - list of lists
-
-            all_msg_ids = []     # input for training or metrics: history + cur_msg (right-side padding)
-            all_msg_masks = []   # 0 on pad tokens and 1 otherwise (right-side padding)
-            all_msg_labels = []  # -100 on history & padding to avoid computing loss (right-side padding)
-
-            for message_ids in message_inputs:
-                cur_ids = [[self.trg_tokenizer.bos_token_id],
-                           message_ids[:self.max_len - 2],
-                           [self.trg_tokenizer.eos_token_id]]
-                cur_labels = [[-100], message_ids[:self.max_len - 2], [-100]]
-
-                # flatten everything into one sequence and convert to tensor of torch.int64
-                cur_ids = torch.tensor([ex for sublist in cur_ids for ex in sublist], dtype=torch.int64)
-                cur_labels = torch.tensor([ex for sublist in cur_labels for ex in sublist], dtype=torch.int64)
-
-                # create ones for attention mask
-                cur_mask = torch.ones_like(cur_ids)
-
-                all_msg_ids.append(cur_ids)
-                all_msg_labels.append(cur_labels)
-                all_msg_masks.append(cur_mask)
-
-            all_diff_ids = [torch.tensor(ids, dtype=torch.int64) for ids in diff_inputs]
-            all_diff_masks = [torch.ones_like(ids) for ids in all_diff_ids]
-
-            msg_max_len = max(len(tensor) for tensor in all_msg_ids)
-            diff_max_len = max(len(tensor) for tensor in all_diff_ids)
-
-            # pad tensors to max length in batch
-            for i, (diff_id_tensor, diff_mask_tensor,
-                    msg_id_tensor, msg_mask_tensor, labels_tensor) in \
-                    enumerate(zip(all_diff_ids, all_diff_masks,
-                                  all_msg_ids, all_msg_masks, all_msg_labels)):
-                # pad ids with pad_token_id (which doesn't really matter for GPT-2)
-                all_msg_ids[i] = torch.nn.functional.pad(msg_id_tensor, pad=[0, msg_max_len - msg_id_tensor.numel()],
-                                                         mode='constant',
-                                                         value=self.trg_tokenizer.pad_token_id)
-                all_diff_ids[i] = torch.nn.functional.pad(diff_id_tensor, pad=[0, diff_max_len - diff_id_tensor.numel()],
-                                                          mode='constant',
-                                                          value=self.src_tokenizer.pad_token_id)
-
-                # pad labels with -100
-                all_msg_labels[i] = torch.nn.functional.pad(labels_tensor, pad=[0, msg_max_len - labels_tensor.numel()],
-                                                            mode='constant', value=-100)
-
-                # pad masks with zeros
-                all_msg_masks[i] = torch.nn.functional.pad(msg_mask_tensor, pad=[0, msg_max_len - msg_mask_tensor.numel()],
-                                                           mode='constant', value=0)
-                all_diff_masks[i] = torch.nn.functional.pad(diff_mask_tensor,
-                                                            pad=[0, diff_max_len - diff_mask_tensor.numel()],
-                                                            mode='constant', value=0)
-
-            all_diff_ids = torch.stack(all_diff_ids)
-            all_diff_masks = torch.stack(all_diff_masks)
-
-            all_msg_ids = torch.stack(all_msg_ids)
-            all_msg_masks = torch.stack(all_msg_masks)
-            all_msg_labels = torch.stack(all_msg_labels)
-
-            return {"diff_input_ids": all_diff_ids,
-                    "diff_attention_mask": all_diff_masks,
-                    "msg_input_ids": all_msg_ids,
-                    "msg_attention_mask": all_msg_masks,
-                    "msg_labels": all_msg_labels}
-        else:
-            batch_size = len(examples)
-            return {"diff_input_ids": torch.randint(10, (batch_size, 500), dtype=torch.int64),
-                    "diff_attention_mask": torch.ones(batch_size, 500, dtype=torch.int64),
-                    "msg_input_ids": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64),
-                    "msg_attention_mask": torch.ones(batch_size, self.max_len, dtype=torch.int64),
-                    "msg_labels": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64)}
+        batch_size = len(examples)
+        return {"diff_input_ids": torch.randint(10, (batch_size, 500), dtype=torch.int64),
+                "diff_attention_mask": torch.ones(batch_size, 500, dtype=torch.bool),
+                "msg_input_ids": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64),
+                "msg_attention_mask": torch.ones(batch_size, self.max_len, dtype=torch.bool),
+                "msg_labels": torch.randint(10, (batch_size, self.max_len), dtype=torch.int64)}
@@ -1,7 +1,7 @@
-import itertools
 from collections import defaultdict
+import multiprocessing
 import os
-from typing import List, Dict
+from typing import List, Dict, Optional
 import pandas as pd
 import json
 from tqdm.notebook import tqdm
@@ -17,6 +17,43 @@ class DataPreprocessor:
     3) Tokenizes diffs and messages
     """
 
+    # what to keep from diff line depending on its first token (None means that line is dropped)
+    _FIRST_TOKEN_HANDLERS = {
+        # name of changed file
+        # example: <FILE> telecomm / java / android / telecomm / Connection . java
+        '<FILE>': lambda tokens: tokens[1:],
+        # lines that were removed
+        # example: - version = ' 2 . 0 . 2 '
+        '-': lambda tokens: tokens,
+        # lines that were added
+        # example: + version = ' 2 . 0 . 3 '
+        '+': lambda tokens: tokens,
+        # some special info that we are not interested in
+        # example: index 0000000 . . 3f26e45
+        'index': lambda tokens: None,
+    }
+
+    # same for first two tokens, checked only when there is no handler for first token
+    _FIRST_TWO_TOKENS_HANDLERS = {
+        # line in git diff when new file is created
+        # example: new file
+        ('new', 'file'): lambda tokens: ['new', 'file'],
+        # line in git diff when file is deleted
+        # example: deleted file
+        ('deleted', 'file'): lambda tokens: ['deleted', 'file'],
+        # line in git diff when file was renamed (old name)
+        # example: rename from src / forge / resources / worldedit . properties
+        ('rename', 'from'): lambda tokens: tokens,
+        # line in git diff when file was renamed (new name)
+        # example: rename to src / forge / resources / defaults / worldedit . properties
+        ('rename', 'to'): lambda tokens: tokens,
+        # some special info that we are not interested in
+        # example: similarity index 100 %
+        ('similarity', 'index'): lambda tokens: None,
+        # example: Binary files a / dependencies / windows / sumatra / SumatraPDF . exe and / dev / null differ
+        ('Binary', 'files'): lambda tokens: tokens,
+    }
+
     @staticmethod
     def _tokenize_git_diff_output_string(diff: str) -> List[List[str]]:
         lines = [line.split() for line in diff.split('<nl>')]
@@ -30,80 +67,35 @@ class DataPreprocessor:
         3) Replaces <nL> with \n
         """
         tokens_per_line = DataPreprocessor._tokenize_git_diff_output_string(git_diff_output)
+        first_token_handlers = DataPreprocessor._FIRST_TOKEN_HANDLERS
+        first_two_tokens_handlers = DataPreprocessor._FIRST_TWO_TOKENS_HANDLERS
 
         diff_lines = []
-        was_special_keyword_modification = False
-
         for tokens_in_line in tokens_per_line:
             if len(tokens_in_line) == 0:
                 # remove empty lines
                 continue
 
-            elif tokens_in_line[0] == '<FILE>':
-                # name of changed file
-                # example: <FILE> telecomm / java / android / telecomm / Connection . java
-                diff_lines.append(tokens_in_line[1:])
-                was_special_keyword_modification = True
-
-            elif tokens_in_line[:2] == ['new', 'file']:
-                # line in git diff when new file is created
-                # example: new file
-                diff_lines.append(['new', 'file'])
-                was_special_keyword_modification = True
-
-            elif tokens_in_line[:2] == ['deleted', 'file']:
-                # line in git diff when file is deleted
-                # example: deleted file
-                diff_lines.append(['deleted', 'file'])
-                was_special_keyword_modification = True
-
-            elif tokens_in_line[:2] == ['rename', 'from']:
-                # line in git diff when file was renamed (old name)
-                # example: rename from src / forge / resources / worldedit . properties
-                diff_lines.append(tokens_in_line)
-                was_special_keyword_modification = True
-
-            elif tokens_in_line[:2] == ['rename', 'to']:
-                # line in git diff when file was renamed (new name)
-                # example: rename to src / forge / resources / defaults / worldedit . properties
-                diff_lines.append(tokens_in_line)
-                was_special_keyword_modification = True
-
-            elif tokens_in_line[0] == '-':
-                # lines that were removed
-                # example: - version = ' 2 . 0 . 2 '
-                diff_lines.append(tokens_in_line)
-
-            elif tokens_in_line[0] == '+':
-                # lines that were added
-                # example: + version = ' 2 . 0 . 3 '
-                diff_lines.append(tokens_in_line)
-
-            elif tokens_in_line[0] == 'index' or tokens_in_line[:2] == ['similarity', 'index']:
-                # some special info that we are not interested in
-                # example 1: index 0000000 . . 3f26e45
-                # example 2: similarity index 100 %
+            handler = first_token_handlers.get(tokens_in_line[0]) or \
+                first_two_tokens_handlers.get(tuple(tokens_in_line[:2]))
+            if handler is None:
+                # all other cases are lines that were not changed (drop them)
                 continue
 
-            else:
-                # all other cases
-                # case 1: line that was not changed (drop them)
-                # case 2: Binary files a / dependencies / windows / sumatra / SumatraPDF . exe and / dev / null differ
-                if tokens_in_line[:2] == ["Binary", "files"]:
-                    diff_lines.append(tokens_in_line)
-
-        diff = ' '.join(itertools.chain(*[line + ['\n'] for line in diff_lines]))
+            tokens_to_keep = handler(tokens_in_line)
+            if tokens_to_keep is not None:
+                # every line ends with \n token
+                diff_lines.append(' '.join(tokens_to_keep) + ' \n' if tokens_to_keep else '\n')
 
-        return diff + '\n'
+        return ' '.join(diff_lines) + '\n'
 
     @staticmethod
-    def preprocess_diffs(git_diff_outputs: List[str]) -> List[str]:
-        diff_res = []
-        for git_diff_output in git_diff_outputs:
-            diff = DataPreprocessor.preprocess_diff(git_diff_output)
-            if diff is not None:
-                diff_res.append(diff)
-        return diff_res
+    def preprocess_diffs(git_diff_outputs: List[str], num_workers: Optional[int] = None) -> List[str]:
+        # diffs are processed independently, so they are split between num_workers processes
+        # (imap keeps the original order, which is needed to put diffs back into dataframe)
+        with multiprocessing.Pool(num_workers or os.cpu_count()) as pool:
+            diffs = pool.imap(DataPreprocessor.preprocess_diff, git_diff_outputs, chunksize=256)
+            return [diff for diff in diffs if diff is not None]
 
     @staticmethod
     def preprocess_messages(msgs: List[str]) -> List[str]:
@@ -130,11 +122,21 @@ class DataPreprocessor:
 
     @staticmethod
     def create_files(ds_root_path: str):
-        for part in ['train', 'val', 'test']:
+        files = os.listdir(ds_root_path)
+        # parts that were already tokenized during previous runs are skipped
+        parts = [part for part in ['train', 'val', 'test']
+                 if f'{part}.json' not in files or f'{part}_history.json' not in files]
+        if not parts:
+            return
+
+        diff_tokenizer = RobertaTokenizerFast.from_pretrained('microsoft/codebert-base')
+        msg_tokenizer = GPT2TokenizerFast.from_pretrained('distilgpt2')
+
+        for part in parts:
             print(f'Processing {part}')
 
             print('Reading data')
-            if f'processed_{part}.csv' not in os.listdir(os.path.join(ds_root_path)):
+            if f'processed_{part}.csv' not in files:
               df = pd.read_csv(os.path.join(ds_root_path, f'{part}.csv'))
 
               print('Processing data')
@@ -146,11 +148,9 @@ class DataPreprocessor:
               df = pd.read_csv(os.path.join(ds_root_path, f'processed_{part}.csv'))
 
             print('Tokenizing diffs')
-            diff_input_ids = DataPreprocessor.tokenize_diffs(df['diff'].tolist(),
-                                                             RobertaTokenizerFast.from_pretrained('microsoft/codebert-base'))
+            diff_input_ids = DataPreprocessor.tokenize_diffs(df['diff'].tolist(), diff_tokenizer)
             print('Tokenizing msgs')
-            msg_input_ids = DataPreprocessor.tokenize_messages(df['message'].tolist(),
-                                                               GPT2TokenizerFast.from_pretrained('distilgpt2'))
+            msg_input_ids = DataPreprocessor.tokenize_messages(df['message'].tolist(), msg_tokenizer)
             print('Constructing history')
             history = defaultdict(list)
             for msg, id in zip(msg_input_ids, df['author'].tolist()):
@@ -1,10 +1,11 @@
 import os
 
+import torch
 import pytorch_lightning as pl
 
 import hydra
 from hydra.utils import instantiate
-from omegaconf import DictConfig, OmegaConf
+from omegaconf import DictConfig, OmegaConf, open_dict
 
 from model.encoder_decoder_module import EncoderDecoderModule
 from model.gpt2_lm_head_module import GPT2LMHeadModule
@@ -18,6 +19,15 @@ def main(cfg: DictConfig) -> None:
     # -----------------------
     pl.seed_everything(42)
 
+    # allow TF32 Tensor Cores for fp32 matmuls & convolutions on Ampere GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+    if 'precision' not in cfg.trainer:
+        # evaluation doesn't need full precision
+        with open_dict(cfg.trainer):
+            cfg.trainer.precision = 16
+
     cfg.dataset.local_rank = int(os.environ.get("LOCAL_RANK", 0))
     cfg.dataset.world_size = cfg.trainer.gpus if cfg.trainer.gpus > 0 else 1
 
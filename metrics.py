@@ -36,17 +36,18 @@ def accuracy_MRR(
     expanded_labels = labels.unsqueeze(-1).expand_as(top_k_predictions)
     true_pos = torch.logical_and(expanded_labels == top_k_predictions, expanded_labels != ignore_index)
 
-    acc_top_1_list = (true_pos[..., :1].sum(dim=1).flatten() /
-                      (labels != ignore_index).sum(dim=1).float())
-    acc_top_1 = torch.mean(acc_top_1_list).item()
+    # number of non-ignored labels in each example (the same for all three metrics)
+    num_labels = (labels != ignore_index).sum(dim=1).float()
 
-    acc_top_k_list = (true_pos.sum(dim=-1).float() /
-                      (labels != ignore_index).sum(dim=1).unsqueeze(1).float()).sum(dim=1)
-
-    acc_top_k = torch.mean(acc_top_k_list).item()
+    acc_top_1_list = true_pos[..., :1].sum(dim=1).flatten() / num_labels
+    acc_top_k_list = (true_pos.sum(dim=-1).float() / num_labels.unsqueeze(1)).sum(dim=1)
 
     true_pos_for_MRR = true_pos / torch.arange(1, true_pos.size(-1) + 1, dtype=torch.float, device=true_pos.device)
-    MRR_top_k_list = true_pos_for_MRR.max(dim=-1)[0].sum(dim=-1) / (labels != ignore_index).sum(dim=1).float()
-    MRR_top_k = torch.mean(MRR_top_k_list).item()
+    MRR_top_k_list = true_pos_for_MRR.max(dim=-1)[0].sum(dim=-1) / num_labels
+
+    # copy all three metrics to CPU at once (every .item() would synchronize with GPU separately)
+    acc_top_1, acc_top_k, MRR_top_k = torch.stack([torch.mean(acc_top_1_list),
+                                                   torch.mean(acc_top_k_list),
+                                                   torch.mean(MRR_top_k_list)]).tolist()
 
     return acc_top_1, acc_top_k, MRR_top_k
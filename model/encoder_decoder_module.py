@@ -1,7 +1,6 @@
 import pandas as pd
 import numpy as np
 from collections import defaultdict
-from copy import copy
 from typing import Optional
 
 import wandb
@@ -9,7 +8,7 @@ import wandb
 import torch
 import pytorch_lightning as pl
 from transformers import EncoderDecoderModel, RobertaModel, RobertaConfig, GPT2LMHeadModel, GPT2Config, \
-    RobertaTokenizer, GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup
+    RobertaTokenizerFast, GPT2TokenizerFast, AdamW, get_linear_schedule_with_warmup
 
 from metrics import accuracy_MRR
 from datasets import load_metric
@@ -21,8 +20,8 @@ nltk.download('wordnet')
 class EncoderDecoderModule(pl.LightningModule):
     def __init__(self,
                  learning_rate: float,
-                 src_tokenizer: RobertaTokenizer,
-                 trg_tokenizer: GPT2Tokenizer,
+                 src_tokenizer: RobertaTokenizerFast,
+                 trg_tokenizer: GPT2TokenizerFast,
                  num_epochs: int,
                  num_batches: int,
                  num_gpus: int,
@@ -30,6 +29,7 @@ class EncoderDecoderModule(pl.LightningModule):
                  num_layers_decoder: Optional[int] = None,
                  encoder_name_or_path: Optional[str] = None,
                  decoder_name_or_path: Optional[str] = None,
+                 freeze_encoder: bool = False,
                  **kwargs):
         super().__init__()
 
@@ -39,14 +39,16 @@ class EncoderDecoderModule(pl.LightningModule):
         self._num_batches = num_batches
         self._num_gpus = num_gpus
         self.learning_rate = learning_rate
+        self._freeze_encoder = freeze_encoder
 
         self.save_hyperparameters()
 
         if encoder_name_or_path is not None and decoder_name_or_path is not None:
             # use pretrained RoBERTa as encoder
             encoder = RobertaModel.from_pretrained(encoder_name_or_path)
-            # resize embeddings to match vocabulary size
-            encoder.resize_token_embeddings(len(self._src_tokenizer))
+            # resize embeddings to match vocabulary size (resizing reallocates the matrix, so skip it if possible)
+            if encoder.get_input_embeddings().num_embeddings != len(self._src_tokenizer):
+                encoder.resize_token_embeddings(len(self._src_tokenizer))
             # remove layers if necessary
             if num_layers_encoder is not None and num_layers_encoder < encoder.config.num_hidden_layers:
                 encoder = EncoderDecoderModule.remove_layers_from_model(encoder, num_layers_encoder, is_gpt=False)
@@ -65,8 +67,9 @@ class EncoderDecoderModule(pl.LightningModule):
             encoder_config = RobertaConfig()
             encoder_config.num_hidden_layers = num_layers_encoder
             encoder = RobertaModel(config=encoder_config)
-            # resize embeddings to match vocabulary size
-            encoder.resize_token_embeddings(len(self._src_tokenizer))
+            # resize embeddings to match vocabulary size (resizing reallocates the matrix, so skip it if possible)
+            if encoder.get_input_embeddings().num_embeddings != len(self._src_tokenizer):
+                encoder.resize_token_embeddings(len(self._src_tokenizer))
 
             # use randomly initialized GPT-2 as decoder
             decoder_config = GPT2Config()
@@ -86,12 +89,37 @@ class EncoderDecoderModule(pl.LightningModule):
         # do not tie output embeddings to input embeddings
         self.model.config.tie_word_embeddings = False
 
+        if self._freeze_encoder:
+            # encoder is not trained: don't compute gradients for it and keep it in eval mode (i.e. without dropout)
+            for param in self.model.encoder.parameters():
+                param.requires_grad = False
+            self.model.encoder.eval()
+
         # to make logs for different batch sizes prettier
         self.examples_count = 0
 
+    @property
+    def encoder(self):
+        return self.model.encoder
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        if self._freeze_encoder:
+            # Lightning switches whole model to train mode after validation, but frozen encoder should stay in eval mode
+            self.model.encoder.eval()
+        return self
+
     def forward(self, batch):
+        encoder_outputs = None
+        if self._freeze_encoder:
+            # no activations need to be saved for backward pass through frozen encoder
+            with torch.no_grad():
+                encoder_outputs = self.model.encoder(input_ids=batch['diff_input_ids'],
+                                                     attention_mask=batch['diff_attention_mask'],
+                                                     return_dict=True)
         return self.model(input_ids=batch['diff_input_ids'],
                           attention_mask=batch['diff_attention_mask'],
+                          encoder_outputs=encoder_outputs,
                           decoder_input_ids=batch['msg_input_ids'],
                           decoder_attention_mask=batch['msg_attention_mask'],
                           labels=batch['msg_labels'])
@@ -161,44 +189,21 @@ class EncoderDecoderModule(pl.LightningModule):
 
     @staticmethod
     def remove_layers_from_model(teacher, num_layers, is_gpt):
-        if not is_gpt:
-            teacher_config = teacher.config
-            student_config = copy(teacher.config)
-            student_config.num_hidden_layers = num_layers
-            student = RobertaModel(config=student_config)
-
-            # copy all embeddings
-            student.embeddings.word_embeddings = teacher.embeddings.word_embeddings
-            student.embeddings.position_embeddings = teacher.embeddings.position_embeddings
-            student.embeddings.token_type_embeddings = teacher.embeddings.token_type_embeddings
-            student.embeddings.LayerNorm = teacher.embeddings.LayerNorm
-            student.embeddings.dropout = teacher.embeddings.dropout
-
-            # uniformly pick from middle layers from teacher
-            # it is basically np.linspace(0, teacher_config.num_hidden_layers,
-            #                             num=student_config.num_hidden_layers, endpoint=True)
-            step = (teacher_config.num_hidden_layers - 1) / (student_config.num_hidden_layers - 1)
-            for student_layer, teacher_layer in enumerate(
-                    int(i * step) for i in range(student_config.num_hidden_layers)):
-                student.encoder.layer[student_layer] = teacher.encoder.layer[teacher_layer]
+        """
+        Removes layers from teacher model in place: embeddings and kept layers are reused as is,
+        so no new model has to be allocated and initialized only to be overwritten.
+        """
+        layers = teacher.transformer.h if is_gpt else teacher.encoder.layer
+
+        # uniformly pick from middle layers from teacher
+        # it is basically np.linspace(0, len(layers), num=num_layers, endpoint=True)
+        step = (len(layers) - 1) / (num_layers - 1)
+        student_layers = torch.nn.ModuleList([layers[int(i * step)] for i in range(num_layers)])
 
+        if is_gpt:
+            teacher.transformer.h = student_layers
+            teacher.config.n_layer = num_layers
         else:
-            teacher_config = teacher.config
-            student_config = copy(teacher.config)
-            student_config.n_layer = num_layers
-
-            student = GPT2LMHeadModel(config=student_config)
-
-            # Copying all embeddings
-            student.transformer.wte = teacher.transformer.wte
-            student.transformer.wpe = teacher.transformer.wpe
-            student.transformer.drop = teacher.transformer.drop
-            # Maybe there is something else in BERT that need to be copied!
-            # Specific thing for GPT2LMHead. Not necessary for BERT
-            student.tie_weights()
-            # Uniformly pick from middle layers from teacher
-            # It is basically np.linspace(0, teacher_config.n_layer, num=student_config.n_layer, endpoint=True)
-            step = (teacher_config.n_layer - 1) / (student_config.n_layer - 1)
-            for student_layer, teacher_layer in enumerate(int(i * step) for i in range(student_config.n_layer)):
-                student.transformer.h[student_layer] = teacher.transformer.h[teacher_layer]
-        return student
+            teacher.encoder.layer = student_layers
+            teacher.config.num_hidden_layers = num_layers
+        return teacher
@@ -1,7 +1,7 @@
 import numpy as np
 
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2LMHeadModel, GPT2TokenizerFast, AdamW, get_linear_schedule_with_warmup
 import pytorch_lightning as pl
 
 from metrics import accuracy_MRR
@@ -13,7 +13,7 @@ nltk.download('wordnet')
 class GPT2LMHeadModule(pl.LightningModule):
     def __init__(self,
                  decoder_name_or_path: str,
-                 tokenizer: GPT2Tokenizer,
+                 tokenizer: GPT2TokenizerFast,
                  learning_rate: float,
                  num_epochs: int,
                  num_batches: int,
@@ -0,0 +1,59 @@
+import unittest
+import torch
+from dataset_utils.data_collators import DataCollatorWithHistory, DataCollatorWithoutHistory
+
+
+class TokenizerOutput:
+    def __init__(self, input_ids):
+        self.input_ids = input_ids
+
+
+class Tokenizer:
+    """Collators only need special token ids and tokenized separator from tokenizer."""
+    pad_token_id = 0
+    bos_token_id = 1
+    eos_token_id = 2
+
+    def __call__(self, text, add_special_tokens=True):
+        return TokenizerOutput([3])
+
+
+class TestDataCollators(unittest.TestCase):
+    def test_without_history(self):
+        collator = DataCollatorWithoutHistory(Tokenizer(), Tokenizer(), max_len=10, pad_to_multiple_of=None)
+        batch = collator([{'diff_input_ids': [8, 9, 10], 'msg_input_ids': [5, 6]},
+                          {'diff_input_ids': [11], 'msg_input_ids': [7]}])
+        self.assertTrue(torch.equal(batch['diff_input_ids'], torch.tensor([[8, 9, 10], [11, 0, 0]])))
+        self.assertTrue(torch.equal(batch['diff_attention_mask'], torch.tensor([[True, True, True],
+                                                                                [True, False, False]])))
+        self.assertTrue(torch.equal(batch['msg_input_ids'], torch.tensor([[1, 5, 6, 2], [1, 7, 2, 0]])))
+        self.assertTrue(torch.equal(batch['msg_attention_mask'], torch.tensor([[True, True, True, True],
+                                                                               [True, True, True, False]])))
+        self.assertTrue(torch.equal(batch['msg_labels'], torch.tensor([[-100, 5, 6, -100], [-100, 7, -100, -100]])))
+
+    def test_with_history(self):
+        # only the latest history message fits into max_len
+        collator = DataCollatorWithHistory(Tokenizer(), Tokenizer(), max_len=8, pad_to_multiple_of=None)
+        batch = collator([{'diff_input_ids': [8], 'msg_input_ids': [5, 6],
+                           'history_input_ids': [[7], [8, 9], [10, 11, 12]]},
+                          {'diff_input_ids': [8], 'msg_input_ids': [5, 6, 7, 8, 9, 10, 11, 12],
+                           'history_input_ids': [[7]]}])
+        self.assertTrue(torch.equal(batch['msg_input_ids'], torch.tensor([[1, 10, 11, 12, 3, 5, 6, 2],
+                                                                          [1, 5, 6, 7, 8, 9, 10, 2]])))
+        self.assertTrue(torch.equal(batch['msg_labels'], torch.tensor([[-100, -100, -100, -100, -100, 5, 6, -100],
+                                                                       [-100, 5, 6, 7, 8, 9, 10, -100]])))
+        self.assertTrue(batch['msg_attention_mask'].all())
+
+    def test_pad_to_multiple_of(self):
+        collator = DataCollatorWithHistory(Tokenizer(), Tokenizer(), max_len=200, pad_to_multiple_of=8)
+        batch = collator([{'diff_input_ids': [8] * 9, 'msg_input_ids': [5, 6], 'history_input_ids': [[7]]}])
+        self.assertEqual(batch['diff_input_ids'].shape, (1, 16))
+        self.assertEqual(batch['msg_input_ids'].shape, (1, 8))
+        self.assertTrue(torch.equal(batch['msg_input_ids'][0, 6:], torch.tensor([0, 0])))
+        self.assertTrue(torch.equal(batch['msg_labels'][0, 6:], torch.tensor([-100, -100])))
+        self.assertFalse(batch['msg_attention_mask'][0, 6:].any())
+        self.assertFalse(batch['diff_attention_mask'][0, 9:].any())
+
+
+if __name__ == '__main__':
+    unittest.main()